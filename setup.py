@@ -33,18 +33,21 @@ setup(
         "Operating System :: Unix",
         "Operating System :: POSIX",
         "Programming Language :: Python",
-        "Programming Language :: Python :: 2.6",
-        "Programming Language :: Python :: 2.7",
-        "Programming Language :: Python :: 3.5",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: Implementation :: CPython",
         "Topic :: Software Development :: Libraries",
     ],
     keywords=[
         "cache", "redis", "decorator",
     ],
+    python_requires=">=3.6",
     install_requires=[
         "redis>=2.10.0"
     ],
+    extras_require={
+        "orjson": ["orjson"],
+    },
     entry_points={
         "console_scripts": [
             "nameless = nameless.__main__:main"
@@ -1,11 +1,51 @@
 # cache.py
 # A minimalist caching decorator which json serializes the output of functions
+import hashlib
 import json
+import logging
+import random
 import time
-import threading
+import uuid
 
-from functools import wraps
-from inspect import getcallargs
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, wraps
+from inspect import signature
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Keys are always encoded with the json module, so that processes with and without
+# orjson installed share the same cache entries.
+def _dumps_key(obj):
+    return json.dumps(obj, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+# Values are encoded and decoded with orjson when it's installed, since it's several
+# times faster than the json module. Anything orjson can't handle, such as integers
+# wider than 64 bits or NaN written by the json module, falls back to json.
+if orjson is not None:
+    def _dumps(obj):
+        try:
+            value = orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return json.dumps(obj)
+        # orjson silently writes NaN and infinite floats as null, so anything containing
+        # a null is re-encoded with json, which preserves them
+        if b'null' in value:
+            return json.dumps(obj)
+        return value
+
+    def _loads(value):
+        try:
+            return orjson.loads(value)
+        except ValueError:
+            return json.loads(value)
+else:
+    _loads = json.loads
+    _dumps = json.dumps
 
 class CacheNameClashException(Exception):
     pass
@@ -13,34 +53,167 @@ class CacheNameClashException(Exception):
 # Though it might make sense to look for name clashes on
 # per-cache level, it is conceivable that we might call
 # create_cache on the same connection twice, so this
-# is a better safeguard against bad habits, even though it's global
+# is a better safeguard against bad habits, even though it's global.
+# Maps each cache name to the qualified name of the function using it.
 decorated = {}
 
-def mangle(fname, f, args, kwargs):
-    # We uniquely identify functions by their list of arguments
-    # as resolved by the function definition.
-    print(fname, f, args, kwargs)
-    print(getcallargs)
-    print(json.dumps(sorted(getcallargs(f, *args, **kwargs).items(), key=lambda x: x[0])))
+# Background cache updates run on a shared, bounded pool rather than a new thread each,
+# so a slow upstream can't pile up an unbounded number of updating threads
+_bg_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='steadycache-bg')
+
+
+def _log_bg_failure(future):
+    """ Reports exceptions from background cache updates, which would otherwise be lost with the future """
+    exc = future.exception()
+    if exc is not None:
+        logger.error("Background cache update failed", exc_info=exc)
+
+# Names of the functions whose update lock is currently held by this process. Other threads
+# check this before asking the cache store for a lock that they would fail to get anyway.
+_updating = set()
+
+# Argument types whose equality implies an identical key encoding. Keys for calls
+# made only with these are memoized in-process. Containers are excluded since
+# e.g. (1,) == (True,) even though they encode differently, and floats since
+# 0.0 == -0.0.
+_memoizable_types = frozenset((str, int, bool, type(None)))
+
+# Results that are already bytes are stored as-is behind a fixed-width header of a marker
+# byte and the timestamp as ASCII (e.g. b'B1792100491.052633<result>'), instead of being
+# encoded as a [timestamp, result] pair, which JSON can't hold and would mean copying them.
+_bytes_marker = b'B'
+_bytes_header_size = 18
 
-    return "@" + fname + "_" + json.dumps(getcallargs(f, *args, **kwargs))
 
+def _encode_entry(timestamp, result):
+    if isinstance(result, bytes):
+        return _bytes_marker + b'%017.6f' % timestamp + result
+    return _dumps((timestamp, result))
 
-def create_cache(cache_store, prefix=""):
+
+def _decode_entry(value):
+    """
+    Returns -- (timestamp, result) of an encoded cache entry. Raises TypeError or ValueError
+        if the entry is corrupt
+    """
+    if value[:1] == _bytes_marker:
+        return float(value[1:_bytes_header_size]), value[_bytes_header_size:]
+    timestamp, result = _loads(value)
+    return timestamp, result
+
+
+# Fetches a cache entry and, if it's missing or older than the expiry time, tries to
+# take the update lock in the same round-trip. The timestamp is read straight off the
+# front of the entry so the result is never decoded in Redis.
+# KEYS: entry key, lock name. ARGV: current time, expires, lock token, lock timeout in ms
+_get_or_lock_script = """
+local value = redis.call('GET', KEYS[1])
+if value then
+    local timestamp
+    if string.sub(value, 1, 1) == 'B' then
+        timestamp = tonumber(string.sub(value, 2, 18))
+    else
+        timestamp = tonumber(string.match(value, '^%[%s*([^,%s]+)'))
+    end
+    if timestamp and tonumber(ARGV[1]) - timestamp <= tonumber(ARGV[2]) then
+        return {value, 0}
+    end
+end
+if redis.call('SET', KEYS[2], ARGV[3], 'NX', 'PX', ARGV[4]) then
+    return {value or false, 1}
+end
+return {value or false, 0}
+"""
+
+# Deletes a lock only if it's still held with the given token, so a lock that timed out
+# and was taken by someone else isn't released out from under them.
+# KEYS: lock name. ARGV: lock token
+_release_lock_script = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class ScriptLock(object):
+    """ A lock taken by the get-or-lock script, released with a compare-and-delete """
+    def __init__(self, release_script, name, token):
+        self.release_script = release_script
+        self.name = name
+        self.token = token
+
+    def release(self):
+        self.release_script(keys=[self.name], args=[self.token])
+
+
+def _is_cluster(cache_store):
+    """ Whether `cache_store` is a Redis Cluster client, which can't run scripts across slots """
+    try:
+        from redis.cluster import RedisCluster
+    except ImportError:
+        return False
+    return isinstance(cache_store, RedisCluster)
+
+
+def mangle(fname, sig, args, kwargs):
+    # We uniquely identify functions by their list of arguments
+    # as resolved by the function's signature, including default values.
+    # The arguments are hashed to keep keys short no matter how large they are,
+    # while the function name stays readable for SCAN and KEYS patterns.
+    bound = sig.bind(*args, **kwargs)
+    bound.apply_defaults()
+    digest = hashlib.blake2b(_dumps_key(bound.arguments), digest_size=16).hexdigest()
+    key = "@" + fname + "_" + digest
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("mangle %s %r %r -> %s", fname, args, kwargs, key)
+    return key
+
+
+def create_cache(cache_store, prefix="", pool_size=None):
     """
     Creates a caching decorator that connects to the given Redis client
     (or any object similarly supporting get(), set() and lock())
 
-    `cache_store` -- An object supporting get(), set(), and lock()
+    When the cache store supports register_script(), as Redis clients do, cache lookups
+    and taking the update lock are combined into a single script call. Redis Cluster clients
+    don't use the script, since an entry and its lock generally live in different slots.
+
+    `cache_store` -- An object supporting get(), set(), and lock(), or a Redis URL
+        (e.g. redis://localhost:6379/0) to connect to through a new connection pool
 
     `prefix` -- a prefix to append to the keys of the cache entries for the functions decorated
         by the returned decorator. This prevents name clashes between identically-named functions
         in the same module
 
+    `pool_size` -- The maximum number of connections in the pool created when `cache_store`
+        is a URL. Defaults to the redis library's default, which is effectively unbounded
+
     Returns -- cache decorator function
     """
+    if isinstance(cache_store, str):
+        import redis
+        pool = redis.ConnectionPool.from_url(cache_store, max_connections=pool_size)
+        cache_store = redis.StrictRedis(connection_pool=pool)
+
+    # Background updates and concurrent callers each need their own connection,
+    # so a single-connection pool serializes all cache traffic
+    if getattr(getattr(cache_store, 'connection_pool', None), 'max_connections', None) == 1:
+        logger.warning("The cache store's connection pool only allows one connection. "
+                       "Concurrent cache lookups and background updates will block on each other")
+
+    if hasattr(cache_store, 'register_script') and not _is_cluster(cache_store):
+        get_or_lock = cache_store.register_script(_get_or_lock_script)
+        release_lock = cache_store.register_script(_release_lock_script)
+    else:
+        get_or_lock = None
 
-    def cache(expires=5, prefix=prefix, bg_caching=False, stale=None):
+    # Clients created with decode_responses=True return entries as strings, so bytes results
+    # stored through them can't be read back and aren't cached
+    connection_kwargs = getattr(getattr(cache_store, 'connection_pool', None), 'connection_kwargs', None) or {}
+    decodes_responses = bool(connection_kwargs.get('decode_responses'))
+
+    def cache(expires=5, prefix=prefix, bg_caching=False, stale=None, retries=0, backoff_base=0.05):
         """
         Decorator for any function which takes json-serializable arguments and returns json-serializable output
         which caches the results for the given arguments in the given redis database.
@@ -52,6 +225,10 @@ def create_cache(cache_store, prefix=""):
             in a background thread
         `stale` -- How long old results can be returned when bg_caching is True, so that two calls don't
             try to update the cache in the background. Defaults to 2 * expires
+        `retries` -- How many times to check the cache again when another caller is already updating it,
+            before giving up and calling the underlying function directly. Defaults to 0
+        `backoff_base` -- The delay before the first retry, doubled on each following retry, with up to
+            as much again added as random jitter. Delays are capped at `stale`
         """
         if not stale:
             stale = 2 * expires
@@ -59,54 +236,144 @@ def create_cache(cache_store, prefix=""):
         def decorate(f):
             fname = prefix + "_" + f.__module__ + "_" + f.__name__
             # Prevent two functions in the same program with the same name from
-            # accidentally stepping on each others' cache.
-            if decorated.get(fname):
+            # accidentally stepping on each others' cache. A module or class level function
+            # may be decorated again under the same qualified name, as happens when its module
+            # is reloaded, and then shares the earlier function's cache entries. Functions
+            # defined inside other functions may not, since each call of the outer function
+            # creates a different function (e.g. a closure over different values) with the
+            # same name. setdefault checks and registers the name atomically.
+            owner = object() if '<locals>' in f.__qualname__ else f.__qualname__
+            if decorated.setdefault(fname, owner) != owner:
                 raise CacheNameClashException("A function with the name " + f.__name__ + " has already been cached elsewhere in this module. Please add a prefix to these functions to uniquely identify them")
-            decorated[fname] = True
+            lock_name = '__lock_' + fname
+            # Look up the attributes used on every lookup once, rather than on each call
+            clock = time.time
+            store_get = cache_store.get
+            new_token = uuid.uuid4
+            # Stores with scripting are Redis, so let it evict entries once they can't be returned anymore:
+            # after `expires`, or after `stale` when background caching may return older results
+            if get_or_lock is not None:
+                ttl = max(expires, stale) if bg_caching else expires
+                set_options = {'px': max(1, int(ttl * 1000))}
+            else:
+                set_options = {}
+            # Resolve the signature once rather than re-inspecting f on every call
+            sig = signature(f)
+
+            # typed=True keeps 1, 1.0 and True apart, since they produce different keys
+            @lru_cache(maxsize=1024, typed=True)
+            def memoized_mangle(*args, **kwargs):
+                return mangle(fname, sig, args, kwargs)
 
-            def update_cache(f, lock, *args, **kwargs):
+            def acquire_lock():
+                """ Takes the update lock through the cache store's lock(), returning None if it's held elsewhere """
+                # Have to use try-finally instead of with, since the implementation of __enter__
+                # in redis.lock.Lock automatically blocks https://github.com/andymccurdy/redis-py/blob/master/redis/lock.py
+                # We don't want thread-local storage because we want to release our lock from the
+                # background thread
+                lock = cache_store.lock(lock_name, timeout=expires, blocking_timeout=0.1, thread_local=False)
+                return lock if lock.acquire() else None
+
+            def lookup(key, lock_first=False):
+                """
+                Fetches the cache entry for `key`, taking the update lock if the entry is missing or expired
+
+                `lock_first` -- Without a get-or-lock script, take the lock before reading the entry, so that
+                    an update finishing while we wait for the lock isn't mistaken for a miss
+
+                Returns -- (hit, age, cached result, lock), where lock is None unless it was acquired
+                """
+                lock = None
+                try_lock = fname not in _updating
+                if try_lock and get_or_lock is not None:
+                    now = clock()
+                    token = new_token().hex
+                    cached_result, locked = get_or_lock(
+                        keys=[key, lock_name],
+                        args=[now, expires, token, max(1, int(expires * 1000))])
+                    if locked:
+                        lock = ScriptLock(release_lock, lock_name, token)
+                else:
+                    if try_lock and lock_first:
+                        lock = acquire_lock()
+                    cached_result = store_get(key)
+                    now = clock()
+
+                hit = False
+                age = None
+                if cached_result is not None:
+                    try:
+                        timestamp, cached_result = _decode_entry(cached_result)
+                        age = now - timestamp
+                        hit = True
+                    except (TypeError, ValueError):
+                        # Treat corrupt or outdated entries as misses
+                        cached_result = None
+
+                if try_lock and get_or_lock is None:
+                    if not hit or age > expires:
+                        if not lock_first:
+                            lock = acquire_lock()
+                    elif lock is not None:
+                        lock.release()
+                        lock = None
+
+                if lock is not None:
+                    _updating.add(fname)
+                return hit, age, cached_result, lock
+
+            def update_cache(lock, key, args, kwargs):
                 try:
                     result = f(*args, **kwargs)
-                    cache_store.set(mangle(fname, f, args, kwargs), json.dumps({'timestamp': time.time(), 'result': result}))
+                    if isinstance(result, bytearray):
+                        # Return the same type as cache hits do
+                        result = bytes(result)
+                    if decodes_responses and isinstance(result, bytes):
+                        return result
+                    cache_store.set(key, _encode_entry(clock(), result), **set_options)
                     return result
                 finally:
+                    _updating.discard(fname)
                     lock.release()
 
             @wraps(f)
             def wrapped(*args, **kwargs):
-                cached_result = cache_store.get(mangle(fname, f, args, kwargs))
-                try:
-                    cached_result = json.loads(cached_result)
-                except:
-                    cached_result = {}
-
-                now = time.time()
-                age = now - cached_result.get('timestamp', 0) if cached_result else now
-                if not cached_result or age > expires:
-                    # Have to use try-finally instead of with, since the implementation of __enter__
-                    # in redis.lock.Lock automatically blocks https://github.com/andymccurdy/redis-py/blob/master/redis/lock.py
-                    # We don't want thread-local storage because we want to release our lock from the
-                    # background thread
-                    lock = cache_store.lock('__lock_' + fname, timeout=expires, blocking_timeout=0.1, thread_local=False)
-                    if lock.acquire():
-                        if bg_caching and cached_result and now - cached_result['timestamp'] < stale:
+                if _memoizable_types.issuperset(map(type, args)) and \
+                        _memoizable_types.issuperset(map(type, kwargs.values())):
+                    key = memoized_mangle(*args, **kwargs)
+                else:
+                    key = mangle(fname, sig, args, kwargs)
+                hit, age, cached_result, lock = lookup(key)
+
+                # If someone else is updating the cache and we have nothing to return in the meantime,
+                # back off and check again rather than duplicating their work
+                for attempt in range(retries):
+                    if lock is not None or (hit and (age <= expires or bg_caching)):
+                        break
+                    time.sleep(min(backoff_base * 2 ** attempt + random.uniform(0, backoff_base), stale))
+                    hit, age, cached_result, lock = lookup(key, lock_first=True)
+
+                if not hit or age > expires:
+                    if lock is not None:
+                        if bg_caching and hit and age < stale:
                             # Update redis in the bg, and return the already-cached result, if we already have something
                             # in the cache and it's still valid.
                             try:
                                 # update_cache releases the lock when it's done
-                                threading.Thread(target=update_cache, args=(f, lock) + args, kwargs=kwargs).start()
+                                _bg_pool.submit(update_cache, lock, key, args, kwargs).add_done_callback(_log_bg_failure)
                             except Exception as e:
+                                _updating.discard(fname)
                                 lock.release()
                                 raise e
                         else:
                             # Otherwise update the cache and return the result of the function in this thread
-                            return update_cache(f, lock, *args, **kwargs)
+                            return update_cache(lock, key, args, kwargs)
                     else:
                         # Can't get the lock, just return the underlying function
-                        if not bg_caching or not cached_result:
+                        if not bg_caching or not hit:
                             return f(*args, **kwargs)
                 
-                return cached_result['result']
+                return cached_result
 
             return wrapped
         return decorate
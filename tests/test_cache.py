@@ -1,14 +1,29 @@
 from __future__ import print_function
 
+import inspect
+import json
+import logging
+import math
+import re
+import sys
 import time
 import threading
 import uuid
 import unittest
 
 from multiprocessing.pool import ThreadPool
+from unittest import mock
 
 from steadycache import cache
 
+try:
+    import fakeredis
+    import lupa
+except ImportError:
+    fakeredis = None
+
+logger = logging.getLogger(__name__)
+
 class MockCache(dict):
     """ Class implementing required cache store object methods"""
     def __init__(self, *args, **kwargs):
@@ -19,7 +34,7 @@ class MockCache(dict):
         t = self.setdefault('__count_' + key, 0)
         self['__count_' + key] = t + 1
         self[key] = value
-        print(key + ": " + value)
+        logger.debug("%s: %s", key, value)
 
     def get_count(self, key):
         """ Helper method to see how many times a cache was set """
@@ -33,43 +48,265 @@ class MockCache(dict):
             def __init__(self, name):
                 self.name = name
                 self.uuid = str(uuid.uuid4())
-                self.lock = threading.Lock()
+                # Notified on release, so waiting acquirers wake up as soon as the lock is free
+                self.cond = threading.Condition()
 
             def release(self):
-                if '__lock_' + self.name in this and this['__lock_' + self.name]['uuid'] == self.uuid:
+                with self.cond:
+                    if '__lock_' + self.name in this and this['__lock_' + self.name]['uuid'] == self.uuid:
+                        del this['__lock_' + self.name]
+                        self.cond.notify_all()
+                        logger.debug("Released %s", self.name)
+                    else:
+                        raise Exception("WE SHOULD NOT BE HERE! Race condition! Did not release self")
+
+            def is_free(self):
+                held = this.get('__lock_' + self.name)
+                if held is None:
+                    return True
+                age = time.time() - held['timestamp']
+                logger.debug("%s held for %s", self.name, age)
+                if age >= (held['timeout'] or float('inf')):
+                    logger.debug("Lock %s timed out.", self.name)
                     del this['__lock_' + self.name]
-                    self.lock.release()
-                    print("Released " + self.name)
-                else:
-                    raise Exception("WE SHOULD NOT BE HERE! Race condition! Did not release self")
+                    return True
+                return False
 
             def acquire(self):
-                slept = 0
-                print("Acquiring " + self.name + " " + str(self.lock))
-                print(this.__repr__)
-                while not self.lock.acquire(False):
-                    age = time.time() - this['__lock_' + self.name]['timestamp']
-                    print(age)
-                    if age < (this['__lock_' + self.name]['timeout'] or float('inf')):
-                        if blocking_timeout and slept > blocking_timeout:
-                            "Failed to acquire " + self.name
-                            return False
-
-                        "Sleeping for {} seconds waiting for {}".format(sleep, self.name)
-                        time.sleep(sleep)
-                        slept += sleep
-
-                    else:
-                        print("Lock " + self.name + " timed out.")
-                        self.release()
-
-                # XXX: This should be atomic enough for tests in cpython considering the GIL?
-                this['__lock_' + self.name] = {'timestamp': time.time(), 'timeout': timeout, 'uuid': self.uuid}
-                print("Acquired " + self.name)
+                logger.debug("Acquiring %s", self.name)
+                with self.cond:
+                    if not self.cond.wait_for(self.is_free, timeout=blocking_timeout):
+                        logger.debug("Failed to acquire %s", self.name)
+                        return False
+
+                    this['__lock_' + self.name] = {'timestamp': time.time(), 'timeout': timeout, 'uuid': self.uuid}
+                logger.debug("Acquired %s", self.name)
                 return True
         return self.locks.setdefault(name, MockLock(name))
 
 
+reloadable_calls = 0
+
+
+def reloadable():
+    """ Module level function for testing redecoration """
+    global reloadable_calls
+    reloadable_calls += 1
+    return reloadable_calls
+
+
+class ScriptedMockCache(MockCache):
+    """ Mock cache store that also supports register_script(), emulating steadycache's Redis scripts """
+    def __init__(self, *args, **kwargs):
+        super(ScriptedMockCache, self).__init__(*args, **kwargs)
+        self.set_options = {}
+        self.script_lock = threading.Lock()
+
+    def set(self, key, value, **kwargs):
+        self.set_options[key] = kwargs
+        super(ScriptedMockCache, self).set(key, value)
+
+    def register_script(self, script):
+        if script == cache._get_or_lock_script:
+            return self.get_or_lock
+        if script == cache._release_lock_script:
+            return self.release_lock
+        raise ValueError("Unknown script")
+
+    def timestamp(self, value):
+        """ Reads an entry's timestamp the same way the get-or-lock script does """
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        if value[:1] == b'B':
+            return float(value[1:18])
+        match = re.match(br'^\[\s*([^,\s]+)', value)
+        return float(match.group(1)) if match else None
+
+    def get_or_lock(self, keys, args):
+        key, lock_name = keys
+        now, expires, token, timeout = args
+        with self.script_lock:
+            value = self.get(key)
+            if value is not None:
+                timestamp = self.timestamp(value)
+                if timestamp is not None and now - timestamp <= expires:
+                    return [value, 0]
+            held = self.get(lock_name)
+            if held is None or held[1] < time.time():
+                self[lock_name] = (token, time.time() + timeout / 1000.0)
+                return [value, 1]
+            return [value, 0]
+
+    def release_lock(self, keys, args):
+        with self.script_lock:
+            held = self.get(keys[0])
+            if held is not None and held[0] == args[0]:
+                del self[keys[0]]
+                return 1
+            return 0
+
+
+class TestScriptedCache(unittest.TestCase):
+    """ Tests of the get-or-lock script path used with Redis """
+    def make_store(self, decode_responses=False):
+        store = ScriptedMockCache()
+        store.connection_pool = mock.Mock(connection_kwargs={'decode_responses': decode_responses})
+        return store
+
+    def lock_held(self, lock_name):
+        return self.store.get(lock_name) is not None
+
+    def setUp(self):
+        self.store = self.make_store()
+        self.cache = cache.create_cache(self.store)
+        # Decorated function names must be unique across test classes
+        self.prefix = type(self).__name__ + "_" + self._testMethodName
+
+    def test_cache_caches(self):
+        self.count_foo = 0
+
+        @self.cache(prefix=self.prefix, expires=0.2)
+        def foo(bar):
+            self.count_foo += 1
+            return [bar, self.count_foo]
+
+        self.assertEqual(foo('a'), ['a', 1])
+        self.assertEqual(foo('a'), ['a', 1])
+        self.assertEqual(foo('b'), ['b', 2])
+        # The lock taken for each miss is released once the entry is written
+        self.assertFalse(self.lock_held('__lock_' + self.prefix + '_' + foo.__module__ + '_foo'))
+
+        time.sleep(0.25)
+        self.assertEqual(foo('a'), ['a', 3])
+
+    def test_cache_caches_bytes(self):
+        self.count_foo = 0
+
+        @self.cache(prefix=self.prefix)
+        def foo():
+            self.count_foo += 1
+            return b'[1, 2]'
+
+        self.assertEqual(foo(), b'[1, 2]')
+        self.assertEqual(foo(), b'[1, 2]')
+        self.assertEqual(self.count_foo, 1)
+
+    def test_bytearray_results(self):
+        @self.cache(prefix=self.prefix)
+        def foo():
+            return bytearray(b'foo')
+
+        self.assertEqual(type(foo()), bytes)
+        self.assertEqual(type(foo()), bytes)
+
+    def test_decode_responses(self):
+        # Bytes results can't be read back through a client that decodes responses, so they aren't cached
+        self.count_foo = 0
+        decoding_cache = cache.create_cache(self.make_store(decode_responses=True))
+
+        @decoding_cache(prefix=self.prefix + "_foo")
+        def foo():
+            self.count_foo += 1
+            return b'caf\xe9'
+
+        @decoding_cache(prefix=self.prefix + "_bar")
+        def bar():
+            return [u'caf\xe9', self.count_foo]
+
+        self.assertEqual(foo(), b'caf\xe9')
+        self.assertEqual(foo(), b'caf\xe9')
+        self.assertEqual(self.count_foo, 2)
+
+        self.assertEqual(bar(), [u'caf\xe9', 2])
+        self.count_foo = 3
+        self.assertEqual(bar(), [u'caf\xe9', 2])
+
+    def test_bg_caching(self):
+        self.count_foo = 0
+
+        @self.cache(prefix=self.prefix, expires=0.2, bg_caching=True)
+        def foo():
+            time.sleep(0.1)
+            self.count_foo += 1
+            return self.count_foo
+
+        self.assertEqual(foo(), 1)
+        time.sleep(0.25)
+        # Stale results are returned while a single background update runs
+        self.assertEqual(foo(), 1)
+        self.assertEqual(foo(), 1)
+        time.sleep(0.15)
+        self.assertEqual(foo(), 2)
+        self.assertEqual(self.count_foo, 2)
+
+    def entry_ttl(self, key):
+        """ The TTL in milliseconds that the entry was written with """
+        return self.store.set_options[key].get('px')
+
+    def test_entry_ttl(self):
+        @self.cache(prefix=self.prefix + "_foo", expires=2)
+        def foo():
+            return 'foo'
+
+        @self.cache(prefix=self.prefix + "_bar", expires=2, bg_caching=True, stale=3)
+        def bar():
+            return 'bar'
+
+        sig = inspect.signature(foo)
+        foo()
+        bar()
+        # Entries outlive `expires` only when background caching may still return them
+        self.assertAlmostEqual(self.entry_ttl(cache.mangle(self.prefix + "_foo_" + foo.__module__ + "_foo", sig, (), {})),
+                               2000, delta=100)
+        self.assertAlmostEqual(self.entry_ttl(cache.mangle(self.prefix + "_bar_" + bar.__module__ + "_bar", sig, (), {})),
+                               3000, delta=100)
+
+    def test_cluster_skips_script(self):
+        # Entries and locks live in different cluster slots, so cluster clients use get() and lock()
+        redis_cluster = mock.MagicMock()
+
+        class RedisCluster(ScriptedMockCache):
+            def register_script(self, script):
+                raise AssertionError("Scripts can't be used on a cluster")
+
+        redis_cluster.RedisCluster = RedisCluster
+        with mock.patch.dict(sys.modules, {'redis': mock.MagicMock(cluster=redis_cluster),
+                                           'redis.cluster': redis_cluster}):
+            cluster_cache = cache.create_cache(RedisCluster())
+
+        @cluster_cache(prefix=self.prefix)
+        def foo():
+            return 'foo'
+
+        self.assertEqual(foo(), 'foo')
+        self.assertEqual(foo(), 'foo')
+
+    def test_release_only_own_lock(self):
+        release = self.store.register_script(cache._release_lock_script)
+        get_or_lock = self.store.register_script(cache._get_or_lock_script)
+        lock_name = '__lock_' + self.prefix
+
+        self.assertEqual(get_or_lock(keys=['@' + self.prefix + '_a', lock_name], args=[time.time(), 1, 'mine', 1000]),
+                         [None, 1])
+        cache.ScriptLock(release, lock_name, 'theirs').release()
+        self.assertTrue(self.lock_held(lock_name))
+        cache.ScriptLock(release, lock_name, 'mine').release()
+        self.assertFalse(self.lock_held(lock_name))
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis with Lua support is not installed")
+class TestFakeRedisCache(TestScriptedCache):
+    """ Runs the script path tests against fakeredis, which executes the Lua scripts themselves """
+    def make_store(self, decode_responses=False):
+        return fakeredis.FakeStrictRedis(decode_responses=decode_responses)
+
+    def lock_held(self, lock_name):
+        return self.store.exists(lock_name)
+
+    def entry_ttl(self, key):
+        return self.store.pttl(key)
+
+
 class TestCache(unittest.TestCase):
     def setUp(self):
         self.mock_redis = MockCache()
@@ -86,6 +323,60 @@ class TestCache(unittest.TestCase):
         self.assertEqual(foo(), 1)
         self.assertEqual(foo(), 1)
 
+    def test_cache_caches_falsy_results(self):
+        self.count_foo = 0
+
+        @self.cache(prefix="test_cache_caches_falsy_results")
+        def foo():
+            self.count_foo += 1
+            return None
+
+        self.assertIsNone(foo())
+        self.assertIsNone(foo())
+        self.assertEqual(self.count_foo, 1)
+
+    def test_cache_caches_bytes(self):
+        self.count_foo = 0
+
+        @self.cache(prefix="test_cache_caches_bytes")
+        def foo():
+            self.count_foo += 1
+            return b'[1, 2]' + bytes(range(256))
+
+        self.assertEqual(foo(), b'[1, 2]' + bytes(range(256)))
+        self.assertEqual(foo(), b'[1, 2]' + bytes(range(256)))
+        self.assertEqual(self.count_foo, 1)
+
+    def test_corrupt_entries_are_misses(self):
+        @self.cache(prefix="test_corrupt_entries_are_misses")
+        def foo():
+            return 'fresh'
+
+        key = cache.mangle("test_corrupt_entries_are_misses_" + foo.__module__ + "_foo",
+                           inspect.signature(foo), (), {})
+        for entry in ('not json', '{"timestamp": 1, "result": "old"}', '[1]', '1', b'Bnot a timestamp'):
+            self.mock_redis[key] = entry
+            self.assertEqual(foo(), 'fresh')
+
+    def test_non_finite_results(self):
+        @self.cache(prefix="test_non_finite_results")
+        def foo():
+            return [float('nan'), float('inf'), float('-inf'), None]
+
+        for _ in range(2):
+            result = foo()
+            self.assertTrue(math.isnan(result[0]))
+            self.assertEqual(result[1:], [float('inf'), float('-inf'), None])
+
+    def test_surrogate_arguments(self):
+        # Undecodable file names from os.listdir() contain lone surrogates
+        @self.cache(prefix="test_surrogate_arguments")
+        def foo(bar):
+            return len(bar)
+
+        self.assertEqual(foo(b'caf\xe9'.decode('utf-8', 'surrogateescape')), 4)
+        self.assertEqual(foo(b'caf\xe9'.decode('utf-8', 'surrogateescape')), 4)
+
     def test_cache_expires(self, expires=5):
         self.count_foo = 0
 
@@ -159,6 +450,26 @@ class TestCache(unittest.TestCase):
         else:
             self.fail()
 
+    def test_redecorate(self):
+        """
+        Decorating a module level function again, e.g. after reloading its module, is allowed and shares its cache
+        """
+        self.assertEqual(self.cache(prefix="test_redecorate")(reloadable)(), 1)
+        self.assertEqual(self.cache(prefix="test_redecorate")(reloadable)(), 1)
+
+    def test_redecorate_local_function(self):
+        """
+        Functions created by a factory have the same qualified name, but must not share a cache
+        """
+        def make(n):
+            @self.cache(prefix="test_redecorate_local_function")
+            def compute():
+                return n
+            return compute
+
+        self.assertEqual(make(1)(), 1)
+        self.assertRaises(cache.CacheNameClashException, make, 2)
+
     def test_update_lock(self):
         """
         Test that locking for updating the cache works
@@ -188,6 +499,26 @@ class TestCache(unittest.TestCase):
         # This was run without a sliding cache, so t2 and t3 should not be the same
         self.assertNotEqual(t3, t2)
 
+    def test_lock_retries(self):
+        """
+        Test that callers who can't get the update lock wait for the result instead of calling the function
+        """
+        self.count_foo = 0
+
+        @self.cache(prefix='test_lock_retries', retries=6, backoff_base=0.05)
+        def foo():
+            time.sleep(0.5)
+            self.count_foo += 1
+            return self.count_foo
+
+        pool = ThreadPool(processes=1)
+        async_result = pool.apply_async(foo, ())
+
+        time.sleep(0.1)
+        self.assertEqual(foo(), 1)
+        self.assertEqual(async_result.get(), 1)
+        self.assertEqual(self.count_foo, 1)
+
     def test_bg_caching(self):
         """
         Test that cache is invalidated and updated, but stale results are returned when background caching is enabled
@@ -214,7 +545,7 @@ class TestCache(unittest.TestCase):
         t4 = t4_.get()
 
         # Cache should return stale results until new ones are valid
-        print(self.mock_redis)
+        logger.debug("%r", self.mock_redis)
         self.assertEqual(t2, t1)
         self.assertEqual(t3, t1)
         self.assertEqual(t4, t1)
@@ -225,8 +556,50 @@ class TestCache(unittest.TestCase):
         # XXX: Test fname
         fname = "test_bg_caching" + "_" + foo.__module__ + "_" + foo.__name__
 
-        # mangle() has to have access to the undecorated function
-        self.assertEqual(self.mock_redis.get_count(cache.mangle(fname, foo_, (), {})), 2)
+        # mangle() has to have access to the undecorated function's signature
+        self.assertEqual(self.mock_redis.get_count(cache.mangle(fname, inspect.signature(foo_), (), {})), 2)
+
+    def test_bg_caching_logs_failures(self):
+        self.count_foo = 0
+
+        @self.cache(bg_caching=True, prefix="test_bg_caching_logs_failures", expires=0.1)
+        def foo():
+            self.count_foo += 1
+            if self.count_foo > 1:
+                raise ValueError("upstream failed")
+            return self.count_foo
+
+        self.assertEqual(foo(), 1)
+        time.sleep(0.15)
+
+        with self.assertLogs(cache.logger, level='ERROR') as logs:
+            # The stale result is returned while the failing update runs in the background
+            self.assertEqual(foo(), 1)
+            time.sleep(0.1)
+        self.assertIn("upstream failed", logs.output[0])
+
+    def test_bg_caching_skips_held_lock(self):
+        """
+        Test that while a background update runs, other calls in this process don't ask the store for the lock
+        """
+        foo = self.cache(bg_caching=True, prefix="test_bg_caching_skips_held_lock", expires=0.2)(
+            lambda: time.sleep(0.5) or time.time())
+
+        t1 = foo()
+        time.sleep(0.3)
+
+        lock = self.mock_redis.lock
+        self.lock_calls = 0
+
+        def counting_lock(*args, **kwargs):
+            self.lock_calls += 1
+            return lock(*args, **kwargs)
+
+        self.mock_redis.lock = counting_lock
+        # The first call starts the background update, and the rest return the stale result
+        for _ in range(3):
+            self.assertEqual(foo(), t1)
+        self.assertEqual(self.lock_calls, 1)
 
     def test_arguments_caching(self):
         # Test that functions calls with differing argument resolve to
@@ -306,6 +679,59 @@ class TestCache(unittest.TestCase):
         self.assertNotEqual(c, d)
 
 
+    def test_dict_argument_order(self):
+        # Dictionary arguments are keyed canonically, regardless of insertion order
+        @self.cache(prefix="test_dict_argument_order")
+        def foo(bar):
+            return str(time.time())
+
+        a = foo({'a': 1, 'b': {'c': 2, 'd': 3}})
+        b = foo({'b': {'d': 3, 'c': 2}, 'a': 1})
+        c = foo({'a': 1, 'b': {'c': 3, 'd': 2}})
+
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, c)
+
+    def test_helper_argument_names(self):
+        # Arguments may share names with the decorator's internal helpers' parameters
+        @self.cache(prefix="test_helper_argument_names")
+        def foo(key, lock=None, f=None, args=None, kwargs=None):
+            return key.upper()
+
+        self.assertEqual(foo(key='b'), 'B')
+        self.assertEqual(foo(key='b', lock=1, f=2, args=3, kwargs=4), 'B')
+        self.assertEqual(foo(key='b'), 'B')
+
+    def test_varargs_caching(self):
+        # Extra positional and keyword arguments are part of the cache key
+        @self.cache(prefix="test_varargs_caching")
+        def foo(a, *args, **kwargs):
+            return str(a) + " " + str(time.time())
+
+        a = foo(1)
+        b = foo(1, 2)
+        c = foo(1, c=2)
+        d = foo(1, c=2)
+
+        self.assertNotEqual(a, b)
+        self.assertNotEqual(a, c)
+        self.assertNotEqual(b, c)
+        self.assertEqual(c, d)
+
+    def test_equal_arguments_of_different_types(self):
+        # 1 == 1.0 == True, but they must not share a cache entry
+        @self.cache(prefix="test_equal_arguments_of_different_types")
+        def foo(bar):
+            return repr(bar)
+
+        self.assertEqual(foo(1), '1')
+        self.assertEqual(foo(1.0), '1.0')
+        self.assertEqual(foo(True), 'True')
+        self.assertEqual(foo(0.0), '0.0')
+        self.assertEqual(foo(-0.0), '-0.0')
+        self.assertEqual(foo((1,)), '(1,)')
+        self.assertEqual(foo((True,)), '(True,)')
+
     def test_stale(self):
         # Test that a stale cache is invalidated
         @self.cache(prefix="test_stale", expires=0.1, bg_caching=True, stale=0.2)
@@ -323,6 +749,57 @@ class TestCache(unittest.TestCase):
         self.assertIsNotNone(b)
         self.assertGreater(now2 - now, 0.2)
 
+    def test_json_edge_values(self):
+        """
+        Arguments and results that orjson can't encode natively are still cached, with keys and values
+        matching what the json module produces
+        """
+        self.count_foo = 0
+
+        @self.cache(prefix="test_json_edge_values")
+        def foo(bar):
+            self.count_foo += 1
+            return bar
+
+        for value, expected in [({1: 'a'}, {'1': 'a'}), (2 ** 70, 2 ** 70), (1e-7, 1e-7), (1e16, 1e16)]:
+            self.assertEqual(foo(value), value)
+            self.assertEqual(foo(value), expected)
+        self.assertEqual(self.count_foo, 4)
+
+        callargs = {'a': {1: 'a'}, 'b': 2 ** 70, 'c': [1e-7, 1e16, 2.5], 'd': 'caf\udce9'}
+        self.assertEqual(cache._dumps_key(callargs),
+                         json.dumps(callargs, sort_keys=True, separators=(',', ':')).encode('utf-8'))
+        for value in callargs.values():
+            self.assertEqual(cache._loads(json.dumps(value)), cache._loads(cache._dumps(value)))
+
+    def test_single_connection_pool_warning(self):
+        class MockPool():
+            max_connections = 1
+
+        self.mock_redis.connection_pool = MockPool()
+        with self.assertLogs(cache.logger, level='WARNING'):
+            cache.create_cache(self.mock_redis)
+
+    def test_redis_url(self):
+        # The redis module is imported lazily, so a stand-in module is enough to check the pool setup
+        redis = mock.MagicMock()
+        with mock.patch.dict(sys.modules, {'redis': redis}):
+            cache.create_cache('redis://localhost:6379/0', pool_size=4)
+
+        redis.ConnectionPool.from_url.assert_called_once_with('redis://localhost:6379/0', max_connections=4)
+        redis.StrictRedis.assert_called_once_with(connection_pool=redis.ConnectionPool.from_url.return_value)
+
+    def test_key_length_is_bounded(self):
+        def foo(bar):
+            pass
+
+        sig = inspect.signature(foo)
+        short = cache.mangle("test_key_length_is_bounded", sig, ('a',), {})
+        long = cache.mangle("test_key_length_is_bounded", sig, ('a' * 10000,), {})
+        self.assertNotEqual(short, long)
+        self.assertEqual(len(short), len(long))
+        self.assertTrue(long.startswith("@test_key_length_is_bounded_"))
+
     def tearDown(self):
         pass
 